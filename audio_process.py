@@ -0,0 +1,133 @@
+import os
+import sys
+import collections
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+# The playback process for reader_qt. Its audio callback has this interpreter's GIL to itself, so synthesis in the
+# GUI process can never hold up a block. It is started once per app and imports only numpy and sounddevice, so it
+# is ready long before the first Play; the GUI imports this module only for PcmRing and PlaybackControls, so
+# sounddevice is imported by the process itself. Every run hands it a new PcmRing in shared memory; commands
+# arrive one per stdin line:
+#   play <ring name> <ring size> <sample rate> <latency>
+#   stop
+# and any command ends the run in progress. The process exits when stdin closes.
+
+# Length of one audio callback period in seconds (20 ms); a fixed, small block keeps the ring-to-speaker delay down
+STREAM_PERIOD = 0.02
+
+def open_shared_memory(name, size):
+    # Creates a block when name is None, otherwise attaches to the GUI process's block. An attaching process
+    # must not let its resource tracker unlink the block when it exits; the creator owns it.
+    if name is None: return shared_memory.SharedMemory(create=True, size=size)
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+class PcmRing:
+    # Single-producer/single-consumer ring of float32 samples between the synth worker and the audio callback,
+    # kept in shared memory so the callback can run in the playback process. Each side only advances its own
+    # counter with an aligned 8-byte store, so neither takes a lock.
+    # line_starts is the sideband of [sample position, line index] marks; the writer may still move a mark it has
+    # queued until the player passes it. It and closed stay in the GUI process.
+    HEADER_BYTES = 64
+    def __init__(self, size, name=None):
+        # Creates a new ring, or attaches to an existing one by its shared memory name
+        self.shm = open_shared_memory(name, self.HEADER_BYTES + size * 4)
+        self.positions = np.ndarray(3, dtype=np.int64, buffer=self.shm.buf)  # write_pos, read_pos, failed; zeroed on create
+        self.buffer = np.ndarray(size, dtype=np.float32, buffer=self.shm.buf, offset=self.HEADER_BYTES); self.mask = size - 1
+        self.line_starts = collections.deque(); self.closed = False
+    @property
+    def write_pos(self): return int(self.positions[0])
+    @write_pos.setter
+    def write_pos(self, value): self.positions[0] = value
+    @property
+    def read_pos(self): return int(self.positions[1])
+    @read_pos.setter
+    def read_pos(self, value): self.positions[1] = value
+    @property
+    def failed(self): return bool(self.positions[2])  # set by the playback process if the device could not be opened
+    @failed.setter
+    def failed(self, value): self.positions[2] = value
+    def available(self): return self.write_pos - self.read_pos
+    def write(self, data, gain=1.0):
+        # Scales and converts (e.g. int16 PCM to float) in the same pass that copies into the ring
+        n = min(len(data), self.buffer.size - self.available())
+        start = self.write_pos & self.mask; first = min(n, self.buffer.size - start)
+        np.multiply(data[:first], gain, out=self.buffer[start:start + first], dtype=np.float32)
+        np.multiply(data[first:n], gain, out=self.buffer[:n - first], dtype=np.float32)
+        self.write_pos += n
+        return n
+    def read_into(self, out, gain=1.0):
+        # Like write(), a gain is applied in the same pass as the copy out of the ring
+        n = min(len(out), self.available())
+        start = self.read_pos & self.mask; first = min(n, self.buffer.size - start)
+        np.multiply(self.buffer[start:start + first], gain, out=out[:first]); np.multiply(self.buffer[:n - first], gain, out=out[first:n])
+        out[n:] = 0  # underrun plays silence
+        self.read_pos += n
+        return n
+    def release(self, unlink=False):
+        # The array views must go before the mapping can be closed; only the creating side unlinks
+        if self.shm is None: return
+        self.positions = self.buffer = None; self.shm.close()
+        if unlink: self.shm.unlink()
+        self.shm = None
+
+class PlaybackControls:
+    # Volume and pause, shared with the playback process so changes reach a running stream immediately.
+    # Plain shared memory takes no lock, which matters since the audio callback reads them every block.
+    def __init__(self, volume=1.0, name=None):
+        self.shm = open_shared_memory(name, 16)
+        self.values = np.ndarray(2, dtype=np.float64, buffer=self.shm.buf)
+        if name is None: self.volume = volume
+    @property
+    def volume(self): return float(self.values[0])
+    @volume.setter
+    def volume(self, value): self.values[0] = value
+    @property
+    def paused(self): return bool(self.values[1])
+    @paused.setter
+    def paused(self, value): self.values[1] = value
+    def release(self, unlink=False):
+        if self.shm is None: return
+        self.values = None; self.shm.close()
+        if unlink: self.shm.unlink()
+        self.shm = None
+
+def open_stream(ring, controls, samplerate, latency):
+    def audio_callback(outdata, frames, time_info, status):
+        # Only pulls from the ring; while paused the ring is left untouched
+        if controls.paused: outdata.fill(0); return
+        # Volume is applied per block as samples leave the ring rather than when filling it, so slider moves
+        # are heard within one block; decode happened on the way in, so each sample is touched once per side
+        ring.read_into(outdata[:, 0], controls.volume)
+    stream = sd.OutputStream(samplerate=samplerate, channels=1, dtype='float32', blocksize=int(samplerate * STREAM_PERIOD), latency=latency,
+                             prime_output_buffers_using_stream_callback=False, callback=audio_callback)
+    stream.start()
+    return stream
+
+def main(controls_name):
+    controls = PlaybackControls(name=controls_name); ring = None; stream = None
+    for command in sys.stdin:
+        if stream is not None: stream.abort(); stream.close(); stream = None  # a stop is immediate, not played out
+        if ring is not None: ring.release(); ring = None
+        parts = command.split()
+        if not parts or parts[0] != 'play': continue
+        name, size, samplerate, latency = parts[1:5]
+        try: latency = float(latency)
+        except ValueError: pass  # one of PortAudio's presets, e.g. 'low'
+        # The GUI unlinks a ring as soon as it stops a run, so a play line read late may name a ring that is
+        # already gone; that run is over and the command is skipped
+        try: ring = PcmRing(int(size), name)
+        except FileNotFoundError: continue
+        try: stream = open_stream(ring, controls, int(samplerate), latency)
+        except Exception as e: print(f"Playback error: {e}", file=sys.stderr); ring.failed = True
+    if stream is not None: stream.abort(); stream.close()
+    if ring is not None: ring.release()
+    controls.release()
+
+if __name__ == "__main__":
+    # PortAudio reads this when sounddevice initializes it; keep its own latency floor down with our low-latency stream
+    os.environ.setdefault("PA_MIN_LATENCY_MSEC", "10")
+    import sounddevice as sd
+    main(sys.argv[1])
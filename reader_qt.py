@@ -1,22 +1,90 @@
 import sys
 import os
 import subprocess
+import select
 import queue
-import sounddevice as sd
+import threading
+import time
+import collections
+import itertools
 import soundfile as sf
-import io
 import numpy as np
 import json
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
-                             QTextEdit, QPushButton, QComboBox, QHBoxLayout,
+                             QTextEdit, QPlainTextEdit, QPushButton, QComboBox, QHBoxLayout,
                              QFileDialog, QMessageBox, QLabel, QSlider, QDialog,
                              QFormLayout, QFontComboBox, QSpinBox, QDialogButtonBox,
                              QColorDialog)
-from PyQt6.QtCore import QObject, QThread, pyqtSignal, Qt
-from PyQt6.QtGui import QTextCursor, QColor, QTextCharFormat, QFont, QAction, QIcon
+from PyQt6.QtCore import QObject, QThread, QThreadPool, QRunnable, QTimer, pyqtSignal, Qt
+from PyQt6.QtGui import QTextCursor, QColor, QTextCharFormat, QTextFormat, QFont, QAction, QIcon
+import audio_process
+from audio_process import PcmRing, PlaybackControls
+
+# The piper Python package (onnxruntime) is optional; without it we fall back to the piper-tts CLI.
+# piper-tts 1.3 replaced synthesize_stream_raw() with synthesize(text, SynthesisConfig); both are supported,
+# and a release offering neither also falls back to the CLI.
+try:
+    import onnxruntime
+    from piper import PiperVoice
+    from piper.config import PiperConfig
+except ImportError:
+    PiperVoice = None
+try:
+    from piper.config import SynthesisConfig
+except ImportError:
+    SynthesisConfig = None
+if PiperVoice is not None and SynthesisConfig is None and not hasattr(PiperVoice, 'synthesize_stream_raw'): PiperVoice = None
 
 # Define the path where Piper voices are stored
 VOICE_DIR = os.path.expanduser("~/.local/share/piper-voices")
+# File extensions recognised as voice models in VOICE_DIR
+VALID_EXTS = ('.onnx',)
+# Lines synthesized concurrently; each worker holds its own piper process or shares the loaded voice
+SYNTH_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+# Largest slice read from piper's stdout at once; small slices reach the audio ring as soon as piper writes them
+PIPE_READ_BYTES = 4096
+# Samples buffered between the synth worker and the playback process (power of two, ~3 s at 22050 Hz)
+RING_SIZE = 1 << 16
+# Short lines are merged into one synthesis request up to this length unless a sentence ends first
+MERGE_MAX_CHARS = 200
+SENTENCE_ENDINGS = ('.', '?', '!')
+# Punctuation piper pauses on inside a sentence; a merged line boundary after one of these is audible
+PAUSE_ENDINGS = (',', ';', ':', '—', '–', '…')
+CLOSING_QUOTES = '"\'”’)'
+# int16 level below which a sample counts as silence when looking for the pause between merged lines
+SILENCE_LEVEL = 100
+# Rough speaking rate at 1.0x, used to place merged lines before their group has been fully synthesized
+SECONDS_PER_CHAR = 0.07
+
+def chunk_lines(lines, max_chars=MERGE_MAX_CHARS, start=0):
+    # Joins short neighbouring lines so each piper call carries a useful amount of text; a blank line (paragraph
+    # break) or a sentence end closes the group. Returns (text, members) pairs; members lists
+    # (line_index, start_fraction, after_pause) for every line folded into text, where after_pause tells whether
+    # piper will pause where the line joins the previous one. line_index is counted from start; lines before
+    # start are skipped in place rather than sliced off a copy.
+    chunks = []; members = []; text = ""
+    for i, line in enumerate(itertools.islice(lines, start, None)):
+        line = line.strip()
+        if members and (not line or text.rstrip(CLOSING_QUOTES).endswith(SENTENCE_ENDINGS) or len(text) + 1 + len(line) > max_chars):
+            chunks.append((text, [(index, offset / len(text), pause) for index, offset, pause in members])); members = []; text = ""
+        if not line: continue
+        after_pause = bool(members) and text.rstrip(CLOSING_QUOTES).endswith(PAUSE_ENDINGS)
+        if members: text += " "
+        members.append((i, len(text), after_pause)); text += line
+    if members: chunks.append((text, [(index, offset / len(text), pause) for index, offset, pause in members]))
+    return chunks
+
+def find_pause(pcm, estimate, radius, min_length):
+    # Returns the middle of the longest quiet run of int16 samples within radius of estimate,
+    # or estimate itself when there is no run of at least min_length samples there
+    lo = max(0, estimate - radius); hi = min(len(pcm), estimate + radius)
+    quiet = np.abs(pcm[lo:hi].astype(np.int32)) < SILENCE_LEVEL
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], quiet, [False])).astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    if not len(starts): return estimate
+    longest = np.argmax(ends - starts)
+    if ends[longest] - starts[longest] < min_length: return estimate
+    return lo + (starts[longest] + ends[longest]) // 2
 
 class SettingsDialog(QDialog):
     # This class is already correctly set up by you. No changes needed.
@@ -60,36 +128,235 @@ class SettingsDialog(QDialog):
     def get_settings(self): return self.settings
 
 
+_voice_configs = {}
+
+def read_voice_config(voice_path):
+    # The parsed <voice>.onnx.json is kept per voice, so later Plays and Saves skip reading it again
+    config = _voice_configs.get(voice_path)
+    if config is None:
+        with open(voice_path + ".json", 'r') as f: config = _voice_configs[voice_path] = json.load(f)
+    return config
+
+def read_voice_sample_rate(voice_path): return read_voice_config(voice_path)["audio"]["sample_rate"]
+
+class PiperProcess:
+    # One long-running piper-tts for a whole run, fed one JSON object per stdin line. With --output-raw piper writes
+    # each utterance's PCM to stdout and only then logs its "Real-time factor" line on stderr, which frames utterances.
+    def __init__(self, voice_path, speed):
+        self.sample_rate = read_voice_sample_rate(voice_path)
+        command = ['piper-tts', '--model', voice_path, '--length_scale', str(1.0 / speed), '--json-input', '--output-raw']
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+        self.stderr_tail = b""
+    def synthesize(self, line):
+        # Yields the line's PCM in PIPE_READ_BYTES slices as piper produces it; an odd trailing byte is held back so
+        # every chunk is whole int16 samples
+        # json.dumps escapes any newline in the text, so one request is always exactly one stdin line
+        self.process.stdin.write(json.dumps({"text": line}).encode('utf-8') + b"\n"); self.process.stdin.flush()
+        out_fd = self.process.stdout.fileno(); err_fd = self.process.stderr.fileno()
+        log = b""; carry = b""; finished = False
+        while True:
+            # Once the log line is in, everything for this line is already in the pipe, so only drain without waiting
+            ready, _, _ = select.select([out_fd] if finished else [out_fd, err_fd], [], [], 0 if finished else None)
+            if not ready: break
+            if out_fd in ready:
+                chunk = os.read(out_fd, PIPE_READ_BYTES)
+                if not chunk:
+                    if finished: break
+                    raise RuntimeError(self.exit_message())
+                carry += chunk; whole = len(carry) & ~1
+                if whole: yield carry[:whole]; carry = carry[whole:]
+            if err_fd in ready and not finished:
+                data = os.read(err_fd, 4096)
+                if not data: raise RuntimeError(self.exit_message())
+                log += data; self.stderr_tail = (self.stderr_tail + data)[-4096:]
+                finished = b"Real-time factor" in log
+        if carry: yield carry
+    def exit_message(self):
+        return f"piper-tts exited unexpectedly:\n\n{self.stderr_tail.decode('utf-8', errors='replace')}"
+    def terminate(self):
+        if self.process.poll() is None: self.process.terminate()
+    def close(self):
+        try: self.process.stdin.close()
+        except OSError: pass
+        self.terminate(); self.process.wait()
+        self.process.stdout.close(); self.process.stderr.close()
+
+def load_piper_voice(voice_path):
+    config = read_voice_config(voice_path)
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = max(1, (os.cpu_count() or 2) // 2)
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(voice_path, sess_options=options, providers=["CPUExecutionProvider"])
+    return PiperVoice(session=session, config=PiperConfig.from_dict(config))
+
+class PiperVoiceSynth:
+    # Same interface as PiperProcess, but synthesizes in-process on an already loaded PiperVoice
+    def __init__(self, voice, speed):
+        self.voice = voice; self.length_scale = 1.0 / speed; self.sample_rate = voice.config.sample_rate
+    def synthesize(self, line):
+        if SynthesisConfig is None: yield from self.voice.synthesize_stream_raw(line, length_scale=self.length_scale); return
+        for chunk in self.voice.synthesize(line, syn_config=SynthesisConfig(length_scale=self.length_scale)): yield chunk.audio_int16_bytes
+    def terminate(self): pass
+    def close(self): pass
+
+_voice_load_lock = threading.Lock()
+
+def get_piper_voice(voice_path, voice_cache=None):
+    with _voice_load_lock:  # pool threads and the startup preload can ask together; load each voice only once
+        voice = voice_cache.get(voice_path) if voice_cache is not None else None
+        if voice is None:
+            voice = load_piper_voice(voice_path)
+            if voice_cache is not None: voice_cache[voice_path] = voice
+    return voice
+
+def open_synth(voice_path, speed, voice_cache=None):
+    if PiperVoice is None: return PiperProcess(voice_path, speed)
+    return PiperVoiceSynth(get_piper_voice(voice_path, voice_cache), speed)
+
+def list_voices():
+    if not os.path.isdir(VOICE_DIR): return []
+    # scandir yields entries with their type already known, so filtering needs no extra stat calls
+    # Hidden files (e.g. editor or sync leftovers like ._voice.onnx) are skipped before anything else is checked
+    with os.scandir(VOICE_DIR) as entries:
+        return sorted(entry.name for entry in entries if not entry.name.startswith('.') and entry.name.endswith(VALID_EXTS) and entry.is_file())
+
+class StartupWorker(QObject):
+    # Lists the installed voices and warms up the preferred one so neither blocks the window from appearing
+    voices_found = pyqtSignal(list)
+    finished = pyqtSignal()
+
+    def __init__(self, preferred_voice, voice_cache):
+        super().__init__(); self.preferred_voice = preferred_voice; self.voice_cache = voice_cache
+    def run(self):
+        try:
+            voices = list_voices(); self.voices_found.emit(voices)
+            voice = self.preferred_voice if self.preferred_voice in voices else (voices[0] if voices else None)
+            if voice and PiperVoice is not None: get_piper_voice(os.path.join(VOICE_DIR, voice), self.voice_cache)
+        except Exception as e: print(f"Voice preload error: {e}")
+        finally: self.finished.emit()
+
+class SynthLineTask(QRunnable):
+    # Synthesizes one line on a QThreadPool thread; chunks go to a per-line queue ended by None
+    def __init__(self, worker, line):
+        super().__init__(); self.setAutoDelete(False)
+        self.worker = worker; self.line = line; self.chunks = queue.Queue(); self.error = None
+    def run(self):
+        try: self.worker.synthesize(self.line, self.chunks)
+        except Exception as e: self.error = e
+        finally: self.chunks.put(None)
+
 class PiperSynthWorker(QObject):
     finished = pyqtSignal()
     error = pyqtSignal(str)
-    save_data_ready = pyqtSignal(object, int)
     
-    def __init__(self, lines, voice_path, audio_queue, speed, for_saving=False):
-        super().__init__(); self.lines = lines; self.voice_path = voice_path; self.audio_queue = audio_queue
-        self.speed = speed; self.for_saving = for_saving; self._is_running = True
+    def __init__(self, lines, voice_path, ring, speed, for_saving=False, voice_cache=None, save_path=None, line_groups=None, line_index_offset=0):
+        super().__init__(); self.lines = lines; self.voice_path = voice_path; self.ring = ring
+        self.speed = speed; self.for_saving = for_saving; self.voice_cache = voice_cache; self.save_path = save_path; self._is_running = True
+        self.line_groups = line_groups; self.line_index_offset = line_index_offset
+        self.synths = []; self._local = threading.local(); self.save_file = None
     def run(self):
+        # Lines are synthesized concurrently, one synth per pool thread, but delivered in order; the oldest
+        # line streams its chunks through as they are produced while later lines buffer theirs
+        pool = QThreadPool(); pool.setMaxThreadCount(SYNTH_WORKERS); pool.setExpiryTimeout(-1)  # keep threads, and their synths, for the run
+        pending = collections.deque()
         try:
-            all_audio_chunks = []; final_samplerate = None
+            self.samplerate = samplerate = read_voice_sample_rate(self.voice_path)
+            # Samples per character, refined from every finished group so later estimates follow this voice
+            self.synth_samples = samplerate * SECONDS_PER_CHAR / self.speed; self.synth_chars = 1
+            if self.for_saving:
+                # Stream straight to disk: only the chunk being written is ever held in memory
+                self.save_file = sf.SoundFile(self.save_path, 'w', samplerate=samplerate, channels=1, format='WAV', subtype='PCM_16')
             for i, line in enumerate(self.lines):
                 if not self._is_running: break
-                length_scale = 1.0 / self.speed
-                command = ['piper-tts', '--model', self.voice_path, '--length_scale', str(length_scale), '--output_file', '-']
-                process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                stdout_data, stderr_data = process.communicate(input=line.encode('utf-8'))
-                if process.returncode != 0: self.error.emit(f"Piper error on line '{line}':\n\n{stderr_data.decode('utf-8')}"); continue
-                if stdout_data:
-                    data, samplerate = sf.read(io.BytesIO(stdout_data), dtype='float32')
-                    if self.for_saving:
-                        all_audio_chunks.append(data)
-                        if final_samplerate is None: final_samplerate = samplerate
-                    else: self.audio_queue.put({'index': i, 'data': data, 'samplerate': samplerate})
-            if self.for_saving and all_audio_chunks: self.save_data_ready.emit(np.concatenate(all_audio_chunks), final_samplerate)
-        except Exception as e: self.error.emit(f"Synthesis worker error:\n\n{e}")
+                task = SynthLineTask(self, line); pool.start(task); pending.append((i, task))
+                if len(pending) < SYNTH_WORKERS: continue
+                self.deliver(*pending.popleft())
+            while pending and self._is_running: self.deliver(*pending.popleft())
+        except Exception as e:
+            if self._is_running: self.error.emit(f"Synthesis worker error:\n\n{e}")
         finally:
-            if not self.for_saving: self.audio_queue.put(None)
+            pool.clear(); pool.waitForDone()  # drop lines not started yet, let running ones end
+            for synth in self.synths: synth.close()
+            if self.save_file: self.save_file.close()
+            # Tells the player that once the ring runs dry the run is complete; a stopped player stops polling on its own
+            if not self.for_saving and self._is_running: self.ring.closed = True
             self.finished.emit()
-    def stop(self): self._is_running = False
+    def synthesize(self, line, chunks):
+        # Called on a pool thread by SynthLineTask
+        if not self._is_running: return
+        synth = getattr(self._local, 'synth', None)
+        if synth is None: synth = self._local.synth = open_synth(self.voice_path, self.speed, self.voice_cache); self.synths.append(synth)
+        for pcm in synth.synthesize(line):
+            if not self._is_running: break
+            chunks.put(pcm)
+    def deliver(self, index, task):
+        group_start = None; group_pcm = []
+        members = self.line_groups[index] if self.line_groups else None
+        keep_pcm = bool(members) and any(pause for _, _, pause in members)  # only needed to find pauses at joins
+        for pcm in iter(task.chunks.get, None):
+            # Piper's raw int16 bytes match the file's PCM_16 subtype, so they are written without any conversion
+            if self.save_file: self.save_file.buffer_write(pcm, dtype='int16')
+            else:
+                # Stays int16 here; conversion to float is fused with the copy into the ring
+                data = np.frombuffer(pcm, dtype=np.int16)
+                if group_start is None:
+                    # Queue every line's mark before any of the group's samples can be read: a group can be longer
+                    # than the ring, so playback may reach a merged line while its group is still being written.
+                    # Until the group's length is known, merged lines are placed using the rate seen so far.
+                    group_start = self.ring.write_pos
+                    estimate = len(self.lines[index]) * self.synth_samples / self.synth_chars
+                    marks = [[group_start + int(fraction * estimate), self.line_index_offset + line_index] for line_index, fraction, _ in members]
+                    self.ring.line_starts.extend(marks)
+                self.write_ring(data)
+                if keep_pcm: group_pcm.append(data)
+        if group_start is not None and self._is_running:
+            length = self.ring.write_pos - group_start
+            self.synth_samples += length; self.synth_chars += len(self.lines[index])
+            self.place_line_starts(marks, members, group_start, length, group_pcm)
+        if task.error: raise task.error  # re-raise a synthesis error from the pool thread
+    def place_line_starts(self, marks, members, group_start, length, group_pcm):
+        # Piper does not report where merged lines meet. Now that the group's length is known, place each by its
+        # share of the group's characters and, where the text makes piper pause at the join, move it to the nearest
+        # pause (up to half a second away). A join without punctuation has no pause of its own, and snapping would
+        # land on an unrelated one. Marks the player has already passed are no longer looked at.
+        pcm = np.concatenate(group_pcm) if group_pcm else None
+        previous = 0
+        for mark, (_, fraction, after_pause) in zip(marks[1:], members[1:]):
+            offset = int(fraction * length)
+            if after_pause and pcm is not None: offset = find_pause(pcm, offset, self.samplerate // 2, self.samplerate // 20)
+            previous = max(previous, offset); mark[0] = group_start + previous  # keep the marks in order
+    def write_ring(self, data):
+        # int16 samples are normalized on their way into the ring, in the same pass as the copy
+        written = 0
+        while self._is_running:
+            written += self.ring.write(data[written:], 1.0 / 32768.0)
+            if written == len(data): return
+            time.sleep(0.01)  # ring is full (or playback is paused), wait for the callback to make room
+    def stop(self):
+        self._is_running = False
+        for synth in list(self.synths): synth.terminate()
+
+class PlaybackProcess:
+    # The audio_process child, started once per app so no Play waits for an interpreter or PortAudio to start;
+    # each run hands it a new ring. It only imports numpy and sounddevice, never this module.
+    def __init__(self, controls): self.controls = controls; self.process = None
+    def start(self):
+        if self.is_alive(): return
+        self.process = subprocess.Popen([sys.executable, audio_process.__file__, self.controls.shm.name], stdin=subprocess.PIPE, text=True, bufsize=1)
+    def is_alive(self): return self.process is not None and self.process.poll() is None
+    def send(self, command):
+        try: self.process.stdin.write(command + "\n"); self.process.stdin.flush()
+        except OSError: pass  # the process died; is_alive() reports it and the next play() starts a new one
+    def play(self, ring, samplerate, latency): self.start(); self.send(f"play {ring.shm.name} {ring.buffer.size} {samplerate} {latency}")
+    def stop(self):
+        if self.is_alive(): self.send("stop")
+    def close(self):
+        if self.process is None: return
+        try: self.process.stdin.close()  # end of input makes the process exit
+        except OSError: pass
+        try: self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired: self.process.kill(); self.process.wait()
+        self.process = None
 
 class AudioPlaybackWorker(QObject):
     playback_finished = pyqtSignal()
@@ -97,38 +364,35 @@ class AudioPlaybackWorker(QObject):
     # --- NEW: Signal for when a line is finished playing ---
     line_completed = pyqtSignal(int)
     
-    def __init__(self, audio_queue, volume, line_index_offset):
-        super().__init__(); self.audio_queue = audio_queue; self.volume = volume
-        self.line_index_offset = line_index_offset; self._is_running = True
-    def run(self):
-        stream = None
-        try:
-            while self._is_running:
-                item = self.audio_queue.get()
-                if item is None: break
-                local_line_index = item['index']; audio_data = item['data']; samplerate = item['samplerate']
-                if not self._is_running: break
-                original_line_index = self.line_index_offset + local_line_index
-                self.highlight_line.emit(original_line_index)
-                if stream is None or stream.samplerate != samplerate:
-                    if stream: stream.close()
-                    stream = sd.OutputStream(samplerate=samplerate, channels=1, dtype='float32'); stream.start()
-                
-                stream.write(audio_data * self.volume) # This call blocks until the audio is done
-                
-                # --- NEW: Emit the completed signal after the audio has been played ---
-                self.line_completed.emit(original_line_index)
-
-        except Exception as e: print(f"Playback error: {e}")
-        finally:
-            if stream: stream.stop(); stream.close()
+    def __init__(self, ring, playback_process, samplerate, latency='low'):
+        super().__init__(); self.ring = ring; self.playback_process = playback_process; self.samplerate = samplerate
+        self.latency = latency; self.playing = False; self.playing_index = None
+        # The audio callback runs in the playback process, so no worker thread is needed here: the GUI thread
+        # polls the ring's read position at 20 Hz for highlighting and to notice the end of the run
+        self.poll_timer = QTimer(self); self.poll_timer.setInterval(50); self.poll_timer.timeout.connect(self.poll)
+    def start(self):
+        self.playback_process.play(self.ring, self.samplerate, self.latency); self.playing = True; self.poll_timer.start()
+    def poll(self):
+        self.emit_progress()
+        # The synth worker closes the ring after its last line; the run is over once the device has played it out
+        finished = self.ring.closed and not self.ring.available()
+        if finished or self.ring.failed or not self.playback_process.is_alive():  # or the device could not be opened
+            self.stop()
+            if finished and self.playing_index is not None: self.line_completed.emit(self.playing_index)
             self.playback_finished.emit()
+    def emit_progress(self):
+        # Highlight a line once the callback has started reading its samples; the one before it is then done.
+        # Lines passed within one poll are all marked completed, but only the last of them is highlighted.
+        read_pos = self.ring.read_pos; line_starts = self.ring.line_starts; highlighted = self.playing_index
+        while line_starts and line_starts[0][0] <= read_pos:
+            _, line_index = line_starts.popleft()
+            # --- NEW: Emit the completed signal after the audio has been played ---
+            if self.playing_index is not None: self.line_completed.emit(self.playing_index)
+            self.playing_index = line_index
+        if self.playing_index != highlighted: self.highlight_line.emit(self.playing_index)
     def stop(self):
-        self._is_running = False
-        while not self.audio_queue.empty():
-            try: self.audio_queue.get_nowait()
-            except queue.Empty: continue
-        self.audio_queue.put(None)
+        self.poll_timer.stop()
+        if self.playing: self.playback_process.stop(); self.playing = False
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -136,9 +400,15 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("Piper-Qt TTS")
         self.setGeometry(100, 100, 800, 600)
         self.lines = []
-        self.last_highlighted_block = None
+        self.line_blocks = [] # QTextBlock per entry of self.lines
+        self.lines_revision = None # document revision self.lines was read at
+        # Playback never edits the document: the current line and the completed lines are view overlays
+        self.highlight_selection = None; self.completed_selections = []; self.completed_cursor = None
         self.playback_state = "stopped"
         self.current_line_index = 0
+        self.voice_cache = {}
+        self.playback_controls = PlaybackControls()
+        self.playback_process = PlaybackProcess(self.playback_controls); self.playback_process.start()
         
         self.config_path = os.path.expanduser("~/.config/piper-qt/settings.json")
         self.settings = {
@@ -146,7 +416,7 @@ class MainWindow(QMainWindow):
             "bg_color": "#ffffff", "text_color": "#000000",
             "highlight_color": "#a8d8ff",
             "completed_color": "#808080",
-            "voice": "", "speed": 10, "volume": 100,
+            "voice": "", "speed": 10, "volume": 100, "latency_ms": 10,
             "session_text": "", "session_cursor_line": 0
         }
         self.load_settings()
@@ -155,7 +425,7 @@ class MainWindow(QMainWindow):
         central_widget = QWidget(); self.setCentralWidget(central_widget)
         layout = QVBoxLayout(central_widget)
         controls_layout = QHBoxLayout()
-        controls_layout.addWidget(QLabel("Voice:")); self.voice_combo = QComboBox(); self.populate_voices()
+        controls_layout.addWidget(QLabel("Voice:")); self.voice_combo = QComboBox()
         controls_layout.addWidget(self.voice_combo)
         controls_layout.addWidget(QLabel("Speed:")); self.speed_slider = QSlider(Qt.Orientation.Horizontal); self.speed_slider.setRange(5, 40); self.speed_slider.setValue(10)
         controls_layout.addWidget(self.speed_slider)
@@ -164,8 +434,9 @@ class MainWindow(QMainWindow):
         controls_layout.addWidget(self.volume_slider)
         self.volume_label = QLabel("100%"); controls_layout.addWidget(self.volume_label)
         layout.addLayout(controls_layout)
-        self.text_edit = QTextEdit(); self.text_edit.setPlaceholderText("Enter text, or open a file from the File menu.")
-        self.text_edit.setLineWrapMode(QTextEdit.LineWrapMode.WidgetWidth)
+        # Plain-text editor: its line-based layout keeps loading and highlighting large books cheap
+        self.text_edit = QPlainTextEdit(); self.text_edit.setPlaceholderText("Enter text, or open a file from the File menu.")
+        self.text_edit.setLineWrapMode(QPlainTextEdit.LineWrapMode.WidgetWidth)
         layout.addWidget(self.text_edit)
         button_layout = QHBoxLayout()
         self.play_button = QPushButton("▶ Play"); self.save_button = QPushButton("Save to WAV"); self.stop_button = QPushButton("⏹ Stop")
@@ -179,19 +450,26 @@ class MainWindow(QMainWindow):
         self.volume_slider.valueChanged.connect(self.update_volume_label)
         self.apply_settings()
         self.restore_session()
+        self.start_startup_worker()
 
     def play_audio(self):
+        if self.playback_state == "paused":
+            # The paused run is still alive, so resuming is just letting the audio callback read again
+            self.playback_controls.paused = False; self.playback_state = "playing"; self.play_button.setText("⏸ Pause")
+            return
         if self.playback_state == "stopped":
             cursor = self.text_edit.textCursor(); self.current_line_index = cursor.blockNumber()
-            full_text = self.text_edit.toPlainText()
-            self.lines = [line for line in full_text.splitlines()]
-        lines_to_play = self.lines[self.current_line_index:]
-        if not lines_to_play: self.full_stop(); return
-        speed = self.speed_slider.value() / 10.0; volume = self.volume_slider.value() / 100.0
-        self.audio_queue = queue.Queue()
-        self.playback_thread = QThread(); self.audio_player = AudioPlaybackWorker(self.audio_queue, volume, self.current_line_index)
-        self.audio_player.moveToThread(self.playback_thread)
-        self.synth_thread = QThread(); self.synth_worker = PiperSynthWorker(lines_to_play, self.get_selected_voice_path(), self.audio_queue, speed)
+            self.read_document_lines(); self.completed_cursor = None
+        chunks = chunk_lines(self.lines, start=self.current_line_index)
+        if not chunks: self.full_stop(); return
+        voice = self.check_selected_voice()
+        if voice is None: return
+        voice_path, samplerate = voice
+        speed = self.speed_slider.value() / 10.0
+        self.audio_ring = PcmRing(RING_SIZE); self.playback_controls.paused = False
+        self.audio_player = AudioPlaybackWorker(self.audio_ring, self.playback_process, samplerate, self.get_stream_latency())
+        self.synth_thread = QThread(); self.synth_worker = PiperSynthWorker([text for text, _ in chunks], voice_path, self.audio_ring, speed, voice_cache=self.voice_cache,
+                                                                  line_groups=[members for _, members in chunks], line_index_offset=self.current_line_index)
         self.synth_worker.moveToThread(self.synth_thread)
         
         self.audio_player.highlight_line.connect(self.update_highlight)
@@ -200,37 +478,47 @@ class MainWindow(QMainWindow):
         self.synth_worker.error.connect(self.show_error)
         self.audio_player.playback_finished.connect(self.on_playback_finished)
         
-        self.playback_thread.started.connect(self.audio_player.run); self.synth_thread.started.connect(self.synth_worker.run)
-        self.playback_thread.start(); self.synth_thread.start()
+        self.synth_thread.started.connect(self.synth_worker.run)
+        self.audio_player.start(); self.synth_thread.start()
         self.playback_state = "playing"; self.play_button.setText("⏸ Pause")
         self.stop_button.setEnabled(True); self.text_edit.setReadOnly(True)
 
     # --- NEW: Slot to handle the line_completed signal ---
     def mark_line_as_completed(self, line_index):
-        doc = self.text_edit.document()
-        block = doc.findBlockByNumber(line_index)
+        block = self.block_for_line(line_index)
         if block.isValid():
-            cursor = QTextCursor(block)
-            fmt = QTextCharFormat()
-            # Set the foreground text color to the completed color
-            fmt.setForeground(QColor(self.settings["completed_color"]))
-            # Ensure the background is cleared
-            fmt.setBackground(Qt.GlobalColor.transparent)
-            cursor.select(QTextCursor.SelectionType.BlockUnderCursor)
-            cursor.mergeCharFormat(fmt)
-            self.last_highlighted_block = None # The block is no longer "highlighted"
+            # Lines complete in order, so one overlay per run grows to cover them all. Like the highlight it leaves
+            # the document, its undo stack and its revision untouched; the cursor follows later edits.
+            if self.completed_cursor is None:
+                self.completed_cursor = QTextCursor(block); selection = QTextEdit.ExtraSelection(); selection.format = self.completed_format
+                self.completed_selections.append(selection)
+            self.completed_cursor.setPosition(block.position() + block.length() - 1, QTextCursor.MoveMode.KeepAnchor)
+            self.completed_selections[-1].cursor = self.completed_cursor
+            self.show_selections()
 
-    def clear_highlight(self, force_clear_all=False):
-        # --- MODIFIED: This function now also resets the text color on a full clear ---
-        clear_format = QTextCharFormat()
-        clear_format.setBackground(Qt.GlobalColor.transparent)
-        if force_clear_all:
-             temp_cursor = QTextCursor(self.text_edit.document()); temp_cursor.select(QTextCursor.SelectionType.Document)
-             temp_cursor.mergeCharFormat(clear_format)
-        elif hasattr(self, 'last_highlighted_block') and self.last_highlighted_block and self.last_highlighted_block.isValid():
-            temp_cursor = QTextCursor(self.last_highlighted_block); temp_cursor.select(QTextCursor.SelectionType.BlockUnderCursor)
-            temp_cursor.mergeCharFormat(clear_format)
-        self.last_highlighted_block = None
+    def read_document_lines(self):
+        # Re-reads the document only if it was edited since the last read, so repeated Plays and Saves are free.
+        # One pass over the blocks gives both the lines and their blocks, so highlighting never searches for a block.
+        document = self.text_edit.document()
+        if document.revision() == self.lines_revision: return self.lines
+        self.lines = []; self.line_blocks = []
+        block = document.firstBlock()
+        while block.isValid(): self.lines.append(block.text()); self.line_blocks.append(block); block = block.next()
+        self.lines_revision = document.revision()
+        return self.lines
+    def block_for_line(self, line_index):
+        if 0 <= line_index < len(self.line_blocks) and self.line_blocks[line_index].isValid(): return self.line_blocks[line_index]
+        return self.text_edit.document().findBlockByNumber(line_index)
+
+    def clear_highlight(self):
+        # The highlight is a view overlay (see update_highlight), so clearing never touches the document;
+        # full_stop also runs when nothing is playing, and then there is nothing to repaint.
+        # Completed lines stay marked after a stop.
+        if self.highlight_selection is None: return
+        self.highlight_selection = None; self.show_selections()
+    def show_selections(self):
+        current = [self.highlight_selection] if self.highlight_selection is not None else []
+        self.text_edit.setExtraSelections(self.completed_selections + current)
 
     # (Other methods are unchanged and omitted for brevity)
     def load_settings(self):
@@ -238,16 +526,20 @@ class MainWindow(QMainWindow):
             if os.path.exists(self.config_path):
                 with open(self.config_path, 'r') as f: self.settings.update(json.load(f))
         except Exception as e: print(f"Could not load settings: {e}")
+        self.saved_settings = self.settings.copy()  # what is on disk; all values are scalars or strings
     def save_settings(self):
         try:
-            self.settings["voice"] = self.voice_combo.currentText(); self.settings["speed"] = self.speed_slider.value(); self.settings["volume"] = self.volume_slider.value()
+            if self.voice_combo.count(): self.settings["voice"] = self.voice_combo.currentText()
+            self.settings["speed"] = self.speed_slider.value(); self.settings["volume"] = self.volume_slider.value()
             self.settings["session_text"] = self.text_edit.toPlainText(); self.settings["session_cursor_line"] = self.text_edit.textCursor().blockNumber()
+            if self.settings == self.saved_settings: return  # nothing changed since the last load or save
             os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
             with open(self.config_path, 'w') as f: json.dump(self.settings, f, indent=4)
+            self.saved_settings = self.settings.copy()
         except Exception as e: print(f"Could not save settings: {e}")
     def restore_session(self):
         if self.settings.get("session_text"):
-            self.text_edit.setText(self.settings["session_text"])
+            self.text_edit.setPlainText(self.settings["session_text"])
             cursor_line = self.settings.get("session_cursor_line", 0)
             block = self.text_edit.document().findBlockByNumber(cursor_line)
             if block.isValid(): self.text_edit.setTextCursor(QTextCursor(block))
@@ -262,7 +554,8 @@ class MainWindow(QMainWindow):
         file_path, _ = QFileDialog.getOpenFileName(self, "Open Text File", "", "Text Files (*.txt);;All Files (*)")
         if file_path:
             try:
-                with open(file_path, 'r', encoding='utf-8') as f: self.text_edit.setText(f.read())
+                with open(file_path, 'r', encoding='utf-8') as f: text = f.read()
+                self.full_stop(); self.completed_selections = []; self.show_selections(); self.text_edit.setPlainText(text)
             except Exception as e: self.show_error(f"Failed to open file:\n\n{e}")
     def open_settings_dialog(self):
         dialog = SettingsDialog(self.settings, self)
@@ -273,67 +566,98 @@ class MainWindow(QMainWindow):
         self.text_edit.setStyleSheet(f"background-color: {self.settings['bg_color']}; color: {self.settings['text_color']};")
         if self.settings["voice"]: self.voice_combo.setCurrentText(self.settings["voice"])
         self.speed_slider.setValue(self.settings["speed"]); self.volume_slider.setValue(self.settings["volume"])
+        # Highlight formats are built here once rather than on every line change
+        self.highlight_format = QTextCharFormat(); self.highlight_format.setBackground(QColor(self.settings["highlight_color"]))
+        self.highlight_format.setProperty(QTextFormat.Property.FullWidthSelection, True)
+        self.completed_format = QTextCharFormat(); self.completed_format.setForeground(QColor(self.settings["completed_color"]))
+        for selection in self.completed_selections: selection.format = self.completed_format
+        if self.highlight_selection is not None: self.highlight_selection.format = self.highlight_format
+        self.show_selections()
     def update_highlight(self, line_index):
-        self.clear_highlight()
         self.current_line_index = line_index
-        doc = self.text_edit.document()
-        block = doc.findBlockByNumber(line_index)
+        block = self.block_for_line(line_index)
         if block.isValid():
-            self.last_highlighted_block = block
-            cursor = QTextCursor(block)
-            fmt = QTextCharFormat(); fmt.setBackground(QColor(self.settings["highlight_color"]))
-            cursor.select(QTextCursor.SelectionType.BlockUnderCursor); cursor.mergeCharFormat(fmt)
+            # An extra selection is drawn over the view, so no char formats, relayout or undo records are involved
+            cursor = QTextCursor(block); cursor.movePosition(QTextCursor.MoveOperation.EndOfBlock, QTextCursor.MoveMode.KeepAnchor)
+            selection = QTextEdit.ExtraSelection(); selection.cursor = cursor; selection.format = self.highlight_format
+            self.highlight_selection = selection; self.show_selections()
             cursor_rect = self.text_edit.cursorRect(cursor)
             viewport_height = self.text_edit.viewport().height()
             if cursor_rect.bottom() > (viewport_height * 0.8):
+                # QPlainTextEdit scrolls in lines rather than pixels
                 scrollbar = self.text_edit.verticalScrollBar()
-                scrollbar.setValue(scrollbar.value() + viewport_height // 2)
+                scrollbar.setValue(scrollbar.value() + viewport_height // 2 // self.text_edit.fontMetrics().lineSpacing())
     def update_speed_label(self, value): self.speed_label.setText(f"{value / 10.0:.1f}x")
-    def update_volume_label(self, value): self.volume_label.setText(f"{value}%")
-    def populate_voices(self):
-        if not os.path.exists(VOICE_DIR): return
-        for file in sorted(os.listdir(VOICE_DIR)):
-            if file.endswith(".onnx"): self.voice_combo.addItem(file)
+    def update_volume_label(self, value):
+        self.volume_label.setText(f"{value}%"); self.playback_controls.volume = value / 100.0
+    def start_startup_worker(self):
+        self.startup_thread = QThread(); self.startup_worker = StartupWorker(self.settings["voice"], self.voice_cache)
+        self.startup_worker.moveToThread(self.startup_thread)
+        self.startup_worker.voices_found.connect(self.populate_voices)
+        self.startup_worker.finished.connect(self.startup_thread.quit)
+        self.startup_thread.started.connect(self.startup_worker.run)
+        self.startup_thread.start()
+    def populate_voices(self, voices):
+        self.voice_combo.addItems(voices)
+        if self.settings["voice"]: self.voice_combo.setCurrentText(self.settings["voice"])
     def toggle_playback(self):
         if self.playback_state == "playing": self.pause_audio()
         else: self.play_audio()
     def pause_audio(self):
-        self.playback_state = "paused"; self.play_button.setText("▶ Resume")
-        if hasattr(self, 'audio_player'): self.audio_player.playback_finished.disconnect(self.on_playback_finished)
-        self.stop_threads()
+        # Workers and threads are kept: the callback plays silence, the ring fills up and synthesis stalls on it
+        self.playback_state = "paused"; self.play_button.setText("▶ Resume"); self.playback_controls.paused = True
     def full_stop(self):
         self.playback_state = "stopped"; self.play_button.setText("▶ Play")
-        self.stop_threads(reset_highlight=True); self.current_line_index = 0; self.lines = []
+        self.stop_threads(reset_highlight=True); self.current_line_index = 0
     def on_playback_finished(self): self.full_stop()
     def stop_threads(self, reset_highlight=False):
         if hasattr(self, 'synth_worker'): self.synth_worker.stop(); self.synth_thread.quit(); self.synth_thread.wait()
-        if hasattr(self, 'audio_player'): self.audio_player.stop(); self.playback_thread.quit(); self.playback_thread.wait()
-        if reset_highlight: self.clear_highlight(force_clear_all=True)
+        if hasattr(self, 'audio_player'): self.audio_player.stop()
+        if hasattr(self, 'audio_ring'): self.audio_ring.release(unlink=True)
+        if reset_highlight: self.clear_highlight()
         self.text_edit.setReadOnly(False); self.stop_button.setEnabled(False)
     def save_audio(self):
-        if self.playback_state == "playing": self.show_error("Please stop playback before saving."); return
-        full_text = self.text_edit.toPlainText()
-        if not full_text.strip(): self.show_error("Text box is empty."); return
+        # A paused run still holds its synth worker and piper processes, so saving waits for a full stop; this is
+        # only a notice, since show_error would stop the paused run
+        if self.playback_state != "stopped": QMessageBox.information(self, "Save Audio", "Please stop playback before saving."); return
+        chunks = chunk_lines(self.read_document_lines())
+        if not chunks: self.show_error("Text box is empty."); return
+        voice = self.check_selected_voice()
+        if voice is None: return
+        voice_path, _ = voice
         save_path, _ = QFileDialog.getSaveFileName(self, "Save Audio", "", "WAV Files (*.wav)")
         if not save_path: return
-        lines_to_save = [line for line in full_text.splitlines() if line.strip()]
+        lines_to_save = [text for text, _ in chunks]
         speed = self.speed_slider.value() / 10.0
         self.save_thread = QThread()
-        self.save_worker = PiperSynthWorker(lines_to_save, self.get_selected_voice_path(), None, speed, for_saving=True)
+        self.save_worker = PiperSynthWorker(lines_to_save, voice_path, None, speed, for_saving=True, voice_cache=self.voice_cache, save_path=save_path)
         self.save_worker.moveToThread(self.save_thread)
-        self.save_worker.save_data_ready.connect(lambda data, sr: sf.write(save_path, data, sr))
         self.save_worker.finished.connect(lambda: (self.save_thread.quit(), self.save_thread.wait(), self.play_button.setEnabled(True), self.save_button.setEnabled(True)))
         self.save_worker.error.connect(self.show_error)
         self.save_thread.started.connect(self.save_worker.run)
+        self.save_thread.start()
         self.play_button.setEnabled(False); self.save_button.setEnabled(False)
+    def get_stream_latency(self):
+        # Suggested output latency in seconds; a non-positive setting leaves it to PortAudio's "low" preset
+        latency_ms = self.settings.get("latency_ms", 10)
+        return latency_ms / 1000.0 if latency_ms > 0 else 'low'
     def get_selected_voice_path(self):
         voice_file = self.voice_combo.currentText()
         if not voice_file: return None
         return os.path.join(VOICE_DIR, voice_file)
+    def check_selected_voice(self):
+        # Shared by Play and Save: returns (voice path, sample rate), or None once the problem has been shown
+        voice_path = self.get_selected_voice_path()
+        if not voice_path: self.show_error("No voice selected."); return None
+        try: return voice_path, read_voice_sample_rate(voice_path)
+        except Exception as e: self.show_error(f"Could not read voice config:\n\n{e}"); return None
     def show_error(self, message):
         QMessageBox.critical(self, "Error", message); self.full_stop()
     def closeEvent(self, event):
-        self.save_settings(); self.full_stop(); event.accept()
+        self.save_settings(); self.full_stop()
+        self.playback_process.close(); self.playback_controls.release(unlink=True)
+        self.startup_thread.quit(); self.startup_thread.wait()
+        event.accept()
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)